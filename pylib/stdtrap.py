@@ -76,14 +76,173 @@ UnitedStdTrap examples with tee to logfile:
 import os
 import sys
 import pty
+import errno
+import fcntl
 import select
+import struct
+import threading
 from StringIO import StringIO
-
-import signal
+from collections import deque
+from itertools import islice
 
 class Error(Exception):
     pass
 
+# how much we ask for in each read() from the trapped fd
+READ_SIZE = 1 << 16
+
+# max number of buffers writev() accepts in one call
+IOV_MAX = 1024
+
+def _get_writev():
+    """-> writev(fd, buffers, offset) or None if unsupported"""
+    try:
+        import ctypes
+        _writev = ctypes.CDLL(None, use_errno=True).writev
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    class iovec(ctypes.Structure):
+        _fields_ = [ ("iov_base", ctypes.c_void_p),
+                     ("iov_len", ctypes.c_size_t) ]
+
+    _writev.argtypes = [ ctypes.c_int, ctypes.POINTER(iovec), ctypes.c_int ]
+    _writev.restype = ctypes.c_ssize_t
+
+    def writev(fd, buffers, offset=0):
+        """write a list of strings to fd in one syscall, skipping the first
+        offset bytes of the first string -> number of bytes written"""
+        iov = (iovec * len(buffers))()
+        for i, buf in enumerate(buffers):
+            # points into buf, which the caller keeps alive for us
+            iov[i].iov_base = ctypes.cast(ctypes.c_char_p(buf),
+                                          ctypes.c_void_p).value
+            iov[i].iov_len = len(buf)
+
+        iov[0].iov_base += offset
+        iov[0].iov_len -= offset
+
+        ret = _writev(fd, iov, len(buffers))
+        if ret == -1:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        return ret
+
+    return writev
+
+writev = _get_writev()
+
+# the eventfd flags are arch-specific: they're defined as the O_* flags
+# of the same name, which differ on e.g. alpha, mips, sparc and parisc.
+# Python 2 has no os.O_CLOEXEC, so we set FD_CLOEXEC with fcntl instead
+EFD_NONBLOCK = os.O_NONBLOCK
+
+def _get_eventfd():
+    """-> eventfd(initval, flags) or None if unsupported"""
+    try:
+        import ctypes
+        _eventfd = ctypes.CDLL(None, use_errno=True).eventfd
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    _eventfd.argtypes = [ ctypes.c_uint, ctypes.c_int ]
+    _eventfd.restype = ctypes.c_int
+
+    def eventfd(initval=0, flags=0):
+        fd = _eventfd(initval, flags)
+        if fd == -1:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        return fd
+
+    return eventfd
+
+eventfd = _get_eventfd()
+
+F_SETPIPE_SZ = 1031
+
+# pipe buffer sizes to try, largest first. Unprivileged users can't go
+# beyond /proc/sys/fs/pipe-max-size
+PIPE_SIZES = (1 << 20, 1 << 18)
+
+# enlarged pipe buffers count against the per-user pipe-user-pages-soft
+# limit, so we cap how many of ours can be enlarged at the same time
+MAX_ENLARGED_PIPES = 16
+_enlarged_pipes = 0
+
+# traps can be opened and closed from several threads
+_enlarged_pipes_lock = threading.Lock()
+
+def enlarge_pipe(fd):
+    """try to grow the buffer of pipe fd -> True if we did"""
+    global _enlarged_pipes
+
+    _enlarged_pipes_lock.acquire()
+    try:
+        if _enlarged_pipes >= MAX_ENLARGED_PIPES:
+            return False
+
+        for size in PIPE_SIZES:
+            try:
+                fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+            except IOError:
+                continue
+
+            _enlarged_pipes += 1
+            return True
+
+        return False
+    finally:
+        _enlarged_pipes_lock.release()
+
+def release_pipes(count):
+    """account for count enlarged pipes having been closed"""
+    global _enlarged_pipes
+
+    _enlarged_pipes_lock.acquire()
+    try:
+        _enlarged_pipes -= count
+    finally:
+        _enlarged_pipes_lock.release()
+
+def set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+class Wakeup:
+    """Wakes up a thread blocked polling fileno(). Uses an eventfd, which
+    unlike a pipe costs one fd and no pipe buffer, or a pipe if we don't
+    have eventfd"""
+    def __init__(self):
+        fd = None
+        if eventfd:
+            try:
+                fd = eventfd(0, EFD_NONBLOCK)
+            except OSError:
+                pass
+
+        if fd is not None:
+            self.r = self.w = fd
+            set_cloexec(fd)
+        else:
+            self.r, self.w = os.pipe()
+            set_cloexec(self.r)
+            set_cloexec(self.w)
+
+    def fileno(self):
+        return self.r
+
+    def send(self):
+        # eventfd only accepts 8 byte counter increments
+        os.write(self.w, struct.pack("=Q", 1))
+
+    def close(self):
+        os.close(self.r)
+        if self.w != self.r:
+            os.close(self.w)
+
 class Splicer:
     """Inside the _splice method, stdout is intercepted at
     the file descriptor level by redirecting it to a pipe. Now
@@ -93,183 +252,212 @@ class Splicer:
     The problem is that if we don't suck data out of this pipe then
     eventually if enough data is written to it the process writing to
     stdout will be blocked by the kernel, which means we'll be limited to
-    capturing up to 65K of output and after that anything else will hang.
-    So to solve that we create a splicer subprocess to get around the OS's
-    65K buffering limitation. The splicer subprocess's job is to suck the
-    pipe into a local buffer and spit it back out to:
-    
-    1) the parent process through a second pipe created for this purpose.
+    capturing as much output as fits in the pipe buffer and after that
+    anything else will hang. So to solve that we start a splicer thread
+    which sucks the pipe into a local buffer while we're trapping output
+    and spits it back out to:
+
+    1) the captured output returned by close()
     2) If `transparent` is True then the data from the local pipe is
        redirected back to the original filedescriptor. 
 
     3) If `tee` is provided then data from the local pipe is tee'ed into those file handles
+
+    Limitation: the splicer thread needs the GIL to run. If C code
+    writes more than the pipe can hold (1 MiB, or 64 KiB if we couldn't
+    enlarge it) in a single call without releasing the GIL (e.g. an
+    extension module printing with write(2)), the writer blocks on the
+    full pipe while holding the GIL and the thread never gets to drain
+    it, so the program hangs. Output from child processes and from
+    Python's own file objects isn't affected.
     """
-    @staticmethod
-    def _splice(spliced_fd, usepty, transparent, tee=[]):
-        """splice into spliced_fd -> (splicer_pid, splicer_reader, orig_fd_dup)"""
-           
-        # duplicate the fd we want to trap for safe keeping
-        orig_fd_dup = os.dup(spliced_fd)
+    def _read(self, r, sinks):
+        """read everything available from r into self.captured and
+        the sinks -> number of sinks that went from empty to having
+        unwritten data. Sinks that already had data are not counted
+        again"""
+        chunks = []
+        while True:
+            try:
+                data = os.read(r, READ_SIZE)
+            except OSError, e:
+                # EIO: pty whose slave side has been closed
+                if e.errno not in (errno.EAGAIN, errno.EIO):
+                    raise
+                break
 
-        # create a bi-directional pipe/pty
-        # data written to w can be read from r
-        if usepty:
-            r, w = os.openpty()
-        else:
-            r, w = os.pipe()
+            if not data:
+                break
 
-        # splice into spliced_fd by overwriting it
-        # with the newly created `w` which we can read from with `r`
-        os.dup2(w, spliced_fd)
-        os.close(w)
-        
-        outpipe = Pipe()
+            chunks.append(data)
 
-        # the child process uses this to signal the parent to continue
-        # the parent uses this to signal the child to close
-        signal_event = SignalEvent()
-        
-        splicer_pid = os.fork()
-        if splicer_pid:
-            signal_continue = signal_event
-            
-            outpipe.w.close()
-            os.close(r)
+        if not chunks:
+            return 0
 
-            while not signal_continue.isSet():
-                pass
+        self.captured.extend(chunks)
 
-            return splicer_pid, outpipe.r, orig_fd_dup
+        # a sink that already had data is waiting for its fd to become
+        # writable. Otherwise there won't be an edge to wake us up, so
+        # write to it straight away
+        pending = 0
+        for sink in sinks:
+            if sink.buffer(chunks) and not sink.write():
+                pending += 1
 
-        signal_closed = signal_event
-        
-        # child splicer
-        outpipe.r.close()
+        return pending
 
-        outpipe = outpipe.w
+    def _splice(self, r, sinks):
+        """splicer thread: read r into self.captured and the sinks
+        until close() wakes us up and there's nothing left to read"""
 
-        # we don't need this copy of spliced_fd
-        # keeping it open will prevent it from closing
-        os.close(spliced_fd)
+        epoll = None
+        try:
+            # make r non-blocking without clobbering its other flags
+            flags = fcntl.fcntl(r, fcntl.F_GETFL)
+            fcntl.fcntl(r, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+            # edge-triggered: we only hear about an fd again after it changes
+            # state, so reads and writes go on until they would block
+            epoll = select.epoll()
+            set_cloexec(epoll.fileno())
+            epoll.register(r, select.EPOLLIN | select.EPOLLET)
+
+            # close() wakes us up through this fd so we can block
+            # without a timeout
+            epoll.register(self.wakeup.fileno(), select.EPOLLIN)
+
+            sinks_by_fd = dict((sink.fd, sink) for sink in sinks)
+            for fd in sinks_by_fd:
+                try:
+                    epoll.register(fd, select.EPOLLOUT | select.EPOLLET)
+                except IOError, e:
+                    # regular files can't be polled, but they never block
+                    if e.errno != errno.EPERM:
+                        raise
+
+            closed = False
+
+            # number of sinks with buffered data
+            pending_sinks = 0
+
+            while not (closed and pending_sinks == 0):
+                try:
+                    events = epoll.poll()
+                except IOError, e:
+                    if e.errno != errno.EINTR:
+                        raise
+                    continue
+
+                for fd, mask in events:
+                    if fd == self.wakeup.fileno():
+                        # whatever was written before close() is in the pipe
+                        # by now, so this read leaves nothing behind
+                        closed = True
+                        epoll.unregister(fd)
+                        pending_sinks += self._read(r, sinks)
 
-        set_blocking(r, False)
-        set_blocking(outpipe.fileno(), False)
-        
-        poll = select.poll()
-        poll.register(r, select.POLLIN | select.POLLHUP)
-        
-        closed = False
-        SignalEvent.send(os.getppid())
-        
-        r_fh = os.fdopen(r, "r", 0)
+                    elif fd == r:
+                        if mask & (select.EPOLLIN | select.EPOLLHUP):
+                            pending_sinks += self._read(r, sinks)
 
-        sinks = [ Sink(outpipe.fileno()) ]
-        if tee:
-            sinks += [ Sink(f) for f in tee ]
-        if transparent:
-            sinks.append(Sink(orig_fd_dup))
+                        if mask & select.EPOLLHUP:
+                            closed = True
+                            epoll.unregister(fd)
+                        
+                    else:
+                        # a pipe whose reader went away while it was full
+                        # reports EPOLLERR without EPOLLOUT. Writing gets
+                        # us the EPIPE that makes the sink drop its data
+                        sink = sinks_by_fd.get(fd)
+                        if sink is not None and sink.total and \
+                           mask & (select.EPOLLOUT | select.EPOLLERR |
+                                   select.EPOLLHUP):
+                            if sink.write():
+                                pending_sinks -= 1
 
-        while True:
-            has_unwritten_data = True in [ sink.data != '' for sink in sinks ]
+        except:
+            # we can't drain the pipe anymore. Closing r below makes
+            # writers fail instead of hang, and close() raises this
+            self.error = sys.exc_info()
 
-            if not closed:
-                closed = signal_closed.isSet()
+        finally:
+            if epoll is not None:
+                epoll.close()
+            os.close(r)
 
-            if closed and not has_unwritten_data:
-                break
+    def __init__(self, spliced_fd, usepty=False, transparent=False, tee=[]):
+        if tee is None:
+            tee = []
 
-            try:
-                events = poll.poll(1)
-            except select.error:
-                events = ()
+        if not isinstance(tee, list):
+            tee = [ tee ]
 
-            for fd, mask in events:
-                if fd == r:
-                    if mask & select.POLLIN:
+        self.spliced_fd = spliced_fd
 
-                        data = r_fh.read()
-                        for sink in sinks:
-                            sink.buffer(data)
-                            poll.register(sink.fd)
+        # duplicate the fd we want to trap for safe keeping
+        self.orig_fd_dup = os.dup(spliced_fd)
+        set_cloexec(self.orig_fd_dup)
 
-                        poll.register(outpipe.fileno(), select.POLLOUT)
+        # create a bi-directional pipe/pty
+        # data written to w can be read from r
+        if usepty:
+            r, w = os.openpty()
+            self.enlarged_pipes = 0
+        else:
+            r, w = os.pipe()
+            self.enlarged_pipes = int(enlarge_pipe(w))
 
-                    if mask & select.POLLHUP:
-                        closed = True
-                        poll.unregister(fd)
-                        
-                else:
-                    for sink in sinks:
-                        if sink.fd != fd:
-                            continue
+        # only spliced_fd (a dup of w) should be inherited by programs we
+        # run. If they inherited r, or anything else of ours, and outlived
+        # the trap, they would keep the pipe alive
+        set_cloexec(r)
 
-                        if mask & select.POLLOUT:
-                            wrote_all = sink.write()
-                            if wrote_all:
-                                poll.unregister(sink.fd)
+        # splice into spliced_fd by overwriting it
+        # with the newly created `w` which we can read from with `r`
+        os.dup2(w, spliced_fd)
+        os.close(w)
 
-        os._exit(0)
-  
-    def __init__(self, spliced_fd, usepty=False, transparent=False, tee=[]):
-        if tee is None:
-            tee = []
+        self.wakeup = Wakeup()
 
-        if not isinstance(tee, list):
-            tee = [ tee ]
+        sinks = [ Sink(f) for f in tee ]
+        if transparent:
+            sinks.append(Sink(self.orig_fd_dup))
 
-        vals = self._splice(spliced_fd, usepty, transparent, tee)
-        self.splicer_pid, self.splicer_reader, self.orig_fd_dup = vals
+        self.captured = []
 
-        self.spliced_fd = spliced_fd
+        # exc_info of whatever killed the splicer thread, raised by close()
+        self.error = None
+
+        self.thread = threading.Thread(target=self._splice, args=(r, sinks))
+        self.thread.setDaemon(True)
+        self.thread.start()
 
     def close(self):
         """closes the splice -> captured output"""
         # dupping orig_fd_dup -> spliced_fd does two things:
-        # 1) it closes spliced_fd - signals our splicer process to stop reading
+        # 1) it closes spliced_fd - so nothing new gets written to the pipe
         # 2) it overwrites spliced_fd with a dup of the unspliced original fd
         os.dup2(self.orig_fd_dup, self.spliced_fd)
-        SignalEvent.send(self.splicer_pid)
-        
-        os.close(self.orig_fd_dup)
 
-        captured = self.splicer_reader.read()
-        os.waitpid(self.splicer_pid, 0)
+        # wake up the splicer thread, it reads what's left and finishes
+        self.wakeup.send()
+        self.thread.join()
 
-        return captured
-
-class SignalEvent:
-    SIG = signal.SIGUSR1
-    
-    @classmethod
-    def send(cls, pid):
-        """send signal event to pid"""
-        os.kill(pid, cls.SIG)
+        os.close(self.orig_fd_dup)
+        self.wakeup.close()
 
-    def _sighandler(self, sig, frame):
-        self.value = True
+        release_pipes(self.enlarged_pipes)
 
-    def __init__(self):
-        self.value = False
-        signal.signal(self.SIG, self._sighandler)
-        
-    def isSet(self):
-        return self.value
+        # we'd otherwise keep a second copy of the output around for as
+        # long as the trap lives
+        captured = ''.join(self.captured)
+        self.captured = []
 
-    def clear(self):
-        self.value = False
-        
-class Pipe:
-    def __init__(self):
-        r, w = os.pipe()
-        self.r = os.fdopen(r, "r", 0)
-        self.w = os.fdopen(w, "w", 0)
+        if self.error:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
 
-def set_blocking(fd, block):
-    import fcntl
-    arg = os.O_NONBLOCK
-    if block:
-        arg =~ arg
-    fcntl.fcntl(fd, fcntl.F_SETFL, arg)
+        return captured
 
 class Sink:
     def __init__(self, fd):
@@ -277,21 +465,59 @@ class Sink:
             fd = fd.fileno()
 
         self.fd = fd
-        self.data = ''
 
-    def buffer(self, data):
-        self.data += data
+        # pending data is queued as a list of chunks so that buffering
+        # and partial writes don't copy the whole backlog every time.
+        # head_off is how much of the first chunk was already written
+        self.chunks = deque()
+        self.head_off = 0
+        self.total = 0
+
+    def buffer(self, chunks):
+        """queue chunks of data for writing
+        -> True if the sink was empty before"""
+        was_empty = self.total == 0
+
+        for data in chunks:
+            self.chunks.append(data)
+            self.total += len(data)
+
+        return was_empty
 
     def write(self):
-        try:
-            written = os.write(self.fd, self.data)
-        except:
-            return False
+        """write buffered data until we're done or fd would block
+        -> True if everything was written"""
+        while self.chunks:
+            try:
+                if writev:
+                    # drain as many queued chunks as we can in one syscall
+                    chunks = list(islice(self.chunks, IOV_MAX))
+                    written = writev(self.fd, chunks, self.head_off)
+                else:
+                    head = memoryview(self.chunks[0])
+                    written = os.write(self.fd, head[self.head_off:])
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+
+                if e.errno == errno.EAGAIN:
+                    return False
+
+                # the sink is broken (e.g. EPIPE). We're edge-triggered, so
+                # it wouldn't get another chance - drop what it had queued
+                self.chunks.clear()
+                self.head_off = 0
+                self.total = 0
+                break
 
-        self.data = self.data[written:]
-        if not self.data:
-            return True
-        return False
+            self.total -= written
+
+            written += self.head_off
+            while self.chunks and written >= len(self.chunks[0]):
+                written -= len(self.chunks.popleft())
+            self.head_off = written
+
+        return True
 
 class StdTrap:
     def __init__(self, stdout=True, stderr=True, usepty=False, transparent=False, stdout_tee=[], stderr_tee=[]):
@@ -314,13 +540,15 @@ class StdTrap:
         self.stderr = None
 
     def close(self):
-        if self.stdout_splice:
-            sys.stdout.flush()
-            self.stdout = StringIO(self.stdout_splice.close())
-
-        if self.stderr_splice:
-            sys.stderr.flush()
-            self.stderr = StringIO(self.stderr_splice.close())
+        # stderr is unspliced even if closing the stdout splice raises
+        try:
+            if self.stdout_splice:
+                sys.stdout.flush()
+                self.stdout = StringIO(self.stdout_splice.close())
+        finally:
+            if self.stderr_splice:
+                sys.stderr.flush()
+                self.stderr = StringIO(self.stderr_splice.close())
 
 class UnitedStdTrap:
     def __init__(self, usepty=False, transparent=False, tee=[]):
@@ -337,12 +565,13 @@ class UnitedStdTrap:
         self.std = self.stderr = self.stdout = None
 
     def close(self):
-        sys.stdout.flush()
-        self.std = self.stderr = self.stdout = StringIO(self.stdout_splice.close())
-
-        sys.stderr.flush()
-        os.dup2(self.stderr_dupfd, sys.stderr.fileno())
-        os.close(self.stderr_dupfd)
+        try:
+            sys.stdout.flush()
+            self.std = self.stderr = self.stdout = StringIO(self.stdout_splice.close())
+        finally:
+            sys.stderr.flush()
+            os.dup2(self.stderr_dupfd, sys.stderr.fileno())
+            os.close(self.stderr_dupfd)
 
 def silence(callback, args=()):
     """convenience function - traps stdout and stderr for callback.
@@ -418,6 +647,30 @@ def tests():
         assert len(trap.stdout.read()) == 71000
         assert len(trap.stderr.read()) == 71000
 
+    def test_big():
+        # more than fits in even an enlarged pipe buffer, so this hangs
+        # unless the splicer drains the pipe while we're trapping
+        trap = StdTrap(stdout=True, stderr=False)
+        try:
+            os.system("head -c 3000000 /dev/zero")
+        finally:
+            trap.close()
+
+        assert len(trap.stdout.read()) == 3000000
+
+    def test_pty():
+        trap = StdTrap(stdout=True, stderr=False, usepty=True)
+        try:
+            os.system("echo hello world")
+            os.system("head -c 3000000 /dev/zero")
+        finally:
+            trap.close()
+
+        # the pty translates \n to \r\n
+        output = trap.stdout.read()
+        assert output.startswith("hello world\r\n")
+        assert len(output) == len("hello world\r\n") + 3000000
+
     def test3():
         trap = UnitedStdTrap(transparent=True)
         try:
@@ -454,6 +707,49 @@ def tests():
 
         assert file("/tmp/log").read() == trapped_output
 
+    def test_tee_broken_pipe():
+        import time
+        import termios
+
+        # a non-blocking tee pipe nobody reads from fills up, then its
+        # reader goes away. close() must not wait for the sink forever
+        r, w = os.pipe()
+        fcntl.fcntl(w, fcntl.F_SETFL, fcntl.fcntl(w, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        trap = StdTrap(stdout=True, stderr=False, stdout_tee=w)
+        try:
+            os.system("head -c 200000 /dev/zero")
+
+            # wait until the splicer has filled the tee pipe
+            while True:
+                buf = fcntl.ioctl(r, termios.FIONREAD, "\0" * 4)
+                if struct.unpack("i", buf)[0] >= 65536:
+                    break
+                time.sleep(0.01)
+
+            os.close(r)
+        finally:
+            trap.close()
+            os.close(w)
+
+        assert len(trap.stdout.read()) == 200000
+
+    def test_tee_error():
+        # an error in the splicer thread is raised by close(), which
+        # still puts stdout back
+        orig = os.fstat(sys.stdout.fileno())
+
+        trap = StdTrap(stdout=True, stderr=False, stdout_tee=[999])
+        try:
+            trap.close()
+        except IOError, e:
+            assert e.errno == errno.EBADF
+        else:
+            assert False, "close() didn't raise"
+
+        restored = os.fstat(sys.stdout.fileno())
+        assert (restored.st_dev, restored.st_ino) == (orig.st_dev, orig.st_ino)
+
     def test_united_tee():
         logfile = file("/tmp/log", "w")
 
@@ -476,8 +772,12 @@ def tests():
     print
     test(True)
     test2()
+    test_big()
+    test_pty()
     test_united_tee()
     test_tee()
+    test_tee_broken_pipe()
+    test_tee_error()
 
 def usage(e=None):
     if e: